@@ -1,33 +1,43 @@
 from flask import Flask
 import os
+import re
 import atexit
 import signal
 import sys
 import logging
+from logging.handlers import MemoryHandler
 import matplotlib
-import matplotlib.font_manager as fm
 from datetime import datetime, timedelta
+from threading import Thread
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from .exchange_rate_manager import ExchangeRateManager
-from .scheduler import init_scheduler
+from .exchange_rate_manager import ExchangeRateManager, fonts_ready
+from .scheduler import init_scheduler, stop_scheduler
+from .utils import load_json_cached, save_json_compact, replace_file, collect_missing_workdays
+
+# 只保留日誌級別為 ERROR 或 CRITICAL 的行
+# 匹配 "] ERROR " 或 "] CRITICAL " 模式以確保匹配的是日誌級別而非消息內容
+_ERROR_LINE_RE = re.compile(rb'\] (?:ERROR|CRITICAL) ')
 
 
 def should_cleanup_today():
     """檢查今天是否需要清理日誌（檢查是否已有今天的日誌）"""
     if not os.path.exists('app.log'):
         return False
-    
+
     try:
-        today_str = datetime.now().strftime('%Y-%m-%d')
-        with open('app.log', 'r', encoding='utf-8') as f:
-            # 檢查前10行是否有今天的日誌（效率考量）
-            for i, line in enumerate(f):
-                if i >= 10:
-                    break
-                if line.startswith(f'[{today_str}'):
-                    # 找到今天的日誌，說明今天已啟動過並開始記錄
-                    return False
-        
+        # 空日誌無需清理，也不必讀取
+        if os.path.getsize('app.log') == 0:
+            return False
+
+        needle = f"[{datetime.now().strftime('%Y-%m-%d')}".encode('utf-8')
+        with open('app.log', 'rb') as f:
+            # 只讀取檔頭一個區塊（效率考量），以 bytes.find 一次掃描
+            head = f.read(8192)
+
+        # 檔頭中有以今天日期開頭的行，說明今天已啟動過並開始記錄
+        if head.startswith(needle) or head.find(b'\n' + needle) != -1:
+            return False
+
         # 沒有找到今天的日誌，需要清理昨天的
         return True
     except Exception:
@@ -40,27 +50,33 @@ def cleanup_daily_logs():
     """清理日誌，只保留錯誤級別的記錄"""
     if not os.path.exists('app.log'):
         return
-    
+
+    tmp_path = 'app.log.tmp'
     try:
-        # 讀取現有日誌
-        with open('app.log', 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        
-        # 只保留日誌級別為 ERROR 或 CRITICAL 的行
-        # 檢查 "] ERROR " 或 "] CRITICAL " 模式以確保匹配的是日誌級別而非消息內容
-        error_lines = [line for line in lines if '] ERROR ' in line or '] CRITICAL ' in line]
-        
-        if error_lines:
-            # 寫回只有錯誤的日誌
-            with open('app.log', 'w', encoding='utf-8') as f:
-                f.writelines(error_lines)
-            print(f"🧹 已清理日誌，保留 {len(error_lines)} 條錯誤記錄")
+        # 逐行串流過濾到暫存檔，避免把整個日誌讀入記憶體
+        # filter() 讓逐行比對在 C 層完成，符合的錯誤行邊寫入邊計數
+        kept = 0
+        with open('app.log', 'rb') as f_in, open(tmp_path, 'wb') as f_out:
+            for line in filter(_ERROR_LINE_RE.search, f_in):
+                f_out.write(line)
+                kept += 1
+
+        if kept:
+            # 以只有錯誤的日誌取代原檔
+            replace_file(tmp_path, 'app.log')
+            print(f"🧹 已清理日誌，保留 {kept} 條錯誤記錄")
         else:
             # 沒有錯誤，刪除文件
+            os.remove(tmp_path)
             os.remove('app.log')
             print("🧹 已清理日誌，無錯誤記錄")
     except Exception as e:
         print(f"⚠️ 清理日誌時發生錯誤: {e}")
+        if os.path.exists(tmp_path):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
 
 
 def setup_logging(app):
@@ -92,6 +108,12 @@ def setup_logging(app):
     file_handler.setFormatter(formatter)
     file_handler.setLevel(getattr(logging, log_level))
     
+    # 緩衝文件寫入：累積 64 筆或遇到 ERROR 以上才寫入磁碟，減少小量寫入
+    mem_handler = MemoryHandler(capacity=64, flushLevel=logging.ERROR, target=file_handler, flushOnClose=True)
+    mem_handler.setLevel(getattr(logging, log_level))
+    # 程式退出時寫出剩餘的緩衝記錄
+    atexit.register(mem_handler.close)
+    
     # 控制台處理器
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(formatter)
@@ -102,7 +124,7 @@ def setup_logging(app):
     app.logger.removeHandler(default_handler)
     
     # 配置 app logger
-    app.logger.addHandler(file_handler)
+    app.logger.addHandler(mem_handler)
     app.logger.addHandler(console_handler)
     app.logger.setLevel(getattr(logging, log_level))
     
@@ -111,7 +133,11 @@ def setup_logging(app):
 
 
 def auto_update_data():
-    """自動判斷並更新數據"""
+    """自動判斷並更新數據
+
+    Returns:
+        dict: 更新後的本地數據（供 ExchangeRateManager 直接使用，避免重複讀取文件）
+    """
     from .mastercard_scraper import MastercardScraper
     from .cookie_fetcher import CookieFetcher
     import json
@@ -123,25 +149,22 @@ def auto_update_data():
     
     # 載入本地數據
     try:
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            local_data = json.load(f)
+        local_data = load_json_cached(DATA_FILE)
     except (FileNotFoundError, json.JSONDecodeError, IOError) as e:
         print(f"⚠️ 載入本地數據失敗: {e}")
         local_data = {}
     
     # 找出應該有數據的最新工作日
     today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-    expected_date = today
     # 如果是週末，回退到上週五
-    while expected_date.weekday() >= 5:
-        expected_date -= timedelta(days=1)
+    expected_date = today - timedelta(days=max(0, today.weekday() - 4))
     
     expected_date_str = expected_date.strftime('%Y-%m-%d')
     
     # 檢查是否需要更新
     if expected_date_str in local_data:
         print(f"✅ 本地數據已是最新（{expected_date_str}）")
-        return
+        return local_data
     
     print(f"⚠️ 需要更新數據（缺少 {expected_date_str}）")
     
@@ -156,12 +179,12 @@ def auto_update_data():
                 print("❌ 無法自動獲取 cookies")
                 print("   💡 提示：請手動運行以下命令：")
                 print("      python app\\cookie_fetcher.py")
-                return
+                return local_data
         except Exception as e:
             print(f"❌ 獲取 cookies 時發生錯誤: {e}")
             print("   💡 提示：請手動運行以下命令：")
             print("      python app\\cookie_fetcher.py")
-            return
+            return local_data
     
     # 使用 scraper 更新數據（並發版本）
     print("🔄 正在更新匯率數據...")
@@ -171,7 +194,7 @@ def auto_update_data():
         # 找出需要更新的日期範圍
         if local_data:
             latest_date_str = max(local_data.keys())
-            latest_date = datetime.strptime(latest_date_str, '%Y-%m-%d')
+            latest_date = datetime.fromisoformat(latest_date_str)
             print(f"   本地最新數據：{latest_date_str}")
         else:
             # 如果沒有數據，從 180 天前開始
@@ -179,15 +202,7 @@ def auto_update_data():
             print(f"   本地無數據，將獲取最近 180 天")
         
         # 收集需要更新的日期（排除週末和已有數據）
-        start_fetch_date = latest_date + timedelta(days=1)
-        dates_to_fetch = []
-        current_date = start_fetch_date
-        while current_date <= today:
-            if current_date.weekday() < 5:  # 只更新工作日
-                date_str = current_date.strftime('%Y-%m-%d')
-                if date_str not in local_data:
-                    dates_to_fetch.append(current_date)
-            current_date += timedelta(days=1)
+        dates_to_fetch = collect_missing_workdays(local_data, latest_date + timedelta(days=1), today)
         
         if not dates_to_fetch:
             print("✅ 數據已是最新，無需更新")
@@ -195,48 +210,64 @@ def auto_update_data():
             print(f"🚀 開始並發抓取 {len(dates_to_fetch)} 個日期的數據...")
             
             # 定義單個日期的抓取函數
-            def fetch_single_date(date_obj):
+            def fetch_single_date(date_obj, date_str):
                 try:
                     data = scraper.get_exchange_rate(date_obj)
-                    date_str = date_obj.strftime('%Y-%m-%d')
+                    status = data.get('status_code') if data else None
                     
                     if data and 'data' in data and 'conversionRate' in data['data']:
                         try:
                             rate = float(data['data']['conversionRate'])
-                            return (date_str, rate, None)
+                            return (date_str, rate, None, status)
                         except (KeyError, ValueError) as e:
-                            return (date_str, None, f"解析失敗: {e}")
+                            return (date_str, None, f"解析失敗: {e}", status)
                     else:
-                        return (date_str, None, "API 未返回有效數據")
+                        error = f"API 未返回有效數據 (HTTP {status})" if status else "API 未返回有效數據"
+                        return (date_str, None, error, status)
                 except Exception as e:
-                    return (date_obj.strftime('%Y-%m-%d'), None, f"請求失敗: {e}")
+                    return (date_str, None, f"請求失敗: {e}", None)
             
             # 並發抓取數據
             updated_count = 0
             failed_count = 0
+            auth_failed = False  # 是否有請求回應 401/403（cookies 失效）
+            got_response = False  # 是否有請求收到其他 HTTP 錯誤回應
+            # 本次更新的批次時間戳（所有新數據共用）
+            batch_ts = datetime.now().isoformat()
             
             with ThreadPoolExecutor(max_workers=12, thread_name_prefix='StartupFetch') as executor:
                 # 提交所有任務
-                future_to_date = {executor.submit(fetch_single_date, d): d for d in dates_to_fetch}
+                future_to_date = {executor.submit(fetch_single_date, d, ds): d for d, ds in dates_to_fetch}
                 
                 # 收集結果
                 for future in as_completed(future_to_date):
-                    date_str, rate, error = future.result()
+                    date_str, rate, error, status = future.result()
                     
                     if rate is not None:
                         local_data[date_str] = {
                             'rate': rate,
-                            'updated': datetime.now().isoformat()
+                            'updated': batch_ts
                         }
                         print(f"   ✅ {date_str}: {rate}")
                         updated_count += 1
                     else:
                         print(f"   ❌ {date_str}: {error}")
                         failed_count += 1
+                        if status in (401, 403):
+                            auth_failed = True
+                        elif status is not None:
+                            got_response = True
             
-            # 如果有太多失敗，可能是 cookies 過期
-            if failed_count > 0 and updated_count == 0:
-                print(f"   ⚠️ 所有請求都失敗了，可能是 cookies 過期")
+            # 全部失敗時判斷是否為 cookies 過期：
+            # GET 回應 401/403 即確定失效；所有失敗都是連線錯誤或逾時時，才以 HEAD 請求探測
+            all_failed = failed_count > 0 and updated_count == 0
+            cookies_expired = all_failed and (
+                auth_failed or (not got_response and not scraper.validate_cookies())
+            )
+            if all_failed and not cookies_expired:
+                print("   ⚠️ 所有請求都失敗了，但並非 Cookies 失效（可能是暫時性問題），略過重新獲取")
+            elif cookies_expired:
+                print(f"   ⚠️ 所有請求都失敗了，cookies 已過期")
                 print("   🍪 嘗試自動重新獲取 Cookies...")
                 try:
                     fetcher = CookieFetcher(COOKIES_FILE)
@@ -245,7 +276,7 @@ def auto_update_data():
                         print("   ✅ Cookies 更新成功，正在重新嘗試抓取數據...")
                         
                         # 重新載入 cookies 並重試
-                        scraper.load_cookies()
+                        scraper.reload_cookies()
                         
                         # 重置計數器
                         updated_count = 0
@@ -253,15 +284,15 @@ def auto_update_data():
                         
                         # 使用新 cookies 重新抓取
                         with ThreadPoolExecutor(max_workers=12, thread_name_prefix='RetryFetch') as executor:
-                            future_to_date = {executor.submit(fetch_single_date, d): d for d in dates_to_fetch}
+                            future_to_date = {executor.submit(fetch_single_date, d, ds): d for d, ds in dates_to_fetch}
                             
                             for future in as_completed(future_to_date):
-                                date_str, rate, error = future.result()
+                                date_str, rate, error, status = future.result()
                                 
                                 if rate is not None:
                                     local_data[date_str] = {
                                         'rate': rate,
-                                        'updated': datetime.now().isoformat()
+                                        'updated': batch_ts
                                     }
                                     print(f"   ✅ {date_str}: {rate}")
                                     updated_count += 1
@@ -283,9 +314,8 @@ def auto_update_data():
             # 保存更新的數據
             if updated_count > 0:
                 # 按日期排序後再保存
-                sorted_data = dict(sorted(local_data.items(), key=lambda x: x[0]))
-                with open(DATA_FILE, 'w', encoding='utf-8') as f:
-                    json.dump(sorted_data, f, ensure_ascii=False, indent=2)
+                local_data = dict(sorted(local_data.items(), key=lambda x: x[0]))
+                save_json_compact(DATA_FILE, local_data)
                 print(f"💾 已保存 {updated_count} 筆新數據到 {DATA_FILE}")
                 if failed_count > 0:
                     print(f"⚠️ 有 {failed_count} 筆數據獲取失敗")
@@ -298,10 +328,42 @@ def auto_update_data():
         print(f"❌ 更新數據時發生錯誤: {e}")
         print("   💡 提示：請檢查網路與 cookies 狀態，系統會在之後自動重試")
 
+    return local_data
+
+def configure_fonts():
+    """設定圖表使用的中文字體（於背景執行緒執行，完成後設定 fonts_ready）"""
+    try:
+        import matplotlib.font_manager as fm
+
+        font_path = os.path.join(os.path.dirname(__file__), '..', 'fonts', 'NotoSansTC-Regular.ttf')
+        if os.path.exists(font_path):
+            # addfont 已解析字體並登記名稱，直接取用其登記項，避免 FontProperties 再次解析 TTF
+            first_new_entry = len(fm.fontManager.ttflist)
+            fm.fontManager.addfont(font_path)
+            matplotlib.rcParams['font.sans-serif'] = [fm.fontManager.ttflist[first_new_entry].name]
+        else:
+            try:
+                matplotlib.rcParams['font.sans-serif'] = ['Noto Sans CJK TC']
+                print("使用系統字體: Noto Sans CJK TC")
+            except Exception as e:
+                matplotlib.rcParams['font.sans-serif'] = ['DejaVu Sans']
+                print(f"警告: 未找到中文字體: {e}")
+                print("請將 NotoSansTC-Regular.ttf 放入 fonts/ 資料夾")
+        matplotlib.rcParams['axes.unicode_minus'] = False
+    except Exception as e:
+        print(f"⚠️ 設定字體時發生錯誤: {e}")
+    finally:
+        # 無論成功與否都放行圖表生成，避免永久阻塞
+        fonts_ready.set()
+
+
 def create_app():
     # 設定非 GUI 後端
     matplotlib.use('Agg')
 
+    # 字體設定與數據更新同時進行，圖表生成前會等待字體就緒
+    Thread(target=configure_fonts, daemon=True, name='FontSetup').start()
+
     app = Flask(__name__, static_folder='../static', template_folder='../templates')
     
     # 設置日誌系統
@@ -310,35 +372,20 @@ def create_app():
     with app.app_context():
         # 在創建 manager 之前先檢查並更新數據
         print("🔄 檢查並更新數據...")
-        auto_update_data()
+        local_data = auto_update_data()
     
-    # 建立服務實例並附加到 app（載入更新後的數據）
-    app.manager = ExchangeRateManager()
+    # 建立服務實例並附加到 app（直接使用更新後的數據，不再重新讀取文件）
+    app.manager = ExchangeRateManager(preloaded_data=local_data)
 
     with app.app_context():
-        # 設定中文字體
-        font_path = os.path.join(os.path.dirname(__file__), '..', 'fonts', 'NotoSansTC-Regular.ttf')
-        if os.path.exists(font_path):
-            fm.fontManager.addfont(font_path)
-            font_prop = fm.FontProperties(fname=font_path)
-            matplotlib.rcParams['font.sans-serif'] = [font_prop.get_name()]
-        else:
-            try:
-                matplotlib.rcParams['font.sans-serif'] = ['Noto Sans CJK TC']
-                print("使用系統字體: Noto Sans CJK TC")
-            except Exception as e:
-                matplotlib.rcParams['font.sans-serif'] = ['DejaVu Sans']
-                print(f"警告: 未找到中文字體: {e}")
-                print("請將 NotoSansTC-Regular.ttf 放入 fonts/ 資料夾")
-        matplotlib.rcParams['axes.unicode_minus'] = False
-        
         # 引入並註冊藍圖
         from . import routes
         app.register_blueprint(routes.bp)
 
         # 在應用程式啟動時執行一次性任務
+        # 保留一天內的圖表：檔名由數據內容雜湊而成，重啟後預熱可直接沿用，不必重新繪製
         print("🧹 清理舊的圖表文件...")
-        app.manager._cleanup_charts_directory(app.manager.charts_dir, max_age_days=0)
+        app.manager._cleanup_charts_directory(app.manager.charts_dir, max_age_days=1)
         
         # 清理舊數據
         app.manager.update_data(180)
@@ -359,6 +406,11 @@ def create_app():
     def cleanup_on_exit():
         """在程式退出時清理所有資源"""
         print("\n🛑 正在關閉應用程式...")
+        # 先停止排程，讓執行中的任務完成後再關閉 manager 的執行緒池
+        try:
+            stop_scheduler()
+        except Exception as e:
+            print(f"⚠️ 停止排程時發生錯誤: {e}")
         if hasattr(app, 'manager'):
             try:
                 app.manager.shutdown()
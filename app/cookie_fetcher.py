@@ -15,41 +15,76 @@ class CookieFetcher:
     使用有頭瀏覽器自動訪問 Mastercard 並獲取有效 cookies
     """
     
-    def __init__(self, cookies_file='mastercard_cookies.json'):
+    # Akamai Bot Manager 反機器人系統的必須 cookies
+    REQUIRED_COOKIES = ('_abck', 'bm_sz', 'bm_sv')
+    
+    def __init__(self, cookies_file='mastercard_cookies.json', profile_dir='.playwright_profile'):
         self.cookies_file = cookies_file
+        # 持久化的瀏覽器設定檔目錄（保留上次的 Akamai 驗證狀態，加快 cookies 生成）
+        self.profile_dir = profile_dir
+    
+    def _watch_set_cookies(self, context):
+        """
+        在 context 上監聽 response 事件，記錄本次會話中 Set-Cookie 標頭下發過的 cookie 名稱
+        
+        須在訪問任何頁面之前呼叫：持久化設定檔的 cookie jar 可能仍保留上次（已被拒絕）的
+        _abck / bm_sz / bm_sv，只有本次重新下發的 cookies 才能視為已就緒。
+        
+        Args:
+            context: Playwright context
+        
+        Returns:
+            tuple: (已下發的 cookie 名稱集合, 必須的 cookies 全部下發時設定的 Event, 監聽函式)
+        """
+        seen = set()
+        all_ready = asyncio.Event()
+        
+        async def on_response(response):
+            try:
+                set_cookie = (await response.all_headers()).get('set-cookie')
+            except Exception:
+                return
+            if not set_cookie:
+                return
+            # 多個 Set-Cookie 以換行合併，每行開頭為 cookie 名稱
+            for line in set_cookie.split('\n'):
+                seen.add(line.split('=', 1)[0].strip())
+            if all(key in seen for key in self.REQUIRED_COOKIES):
+                all_ready.set()
+        
+        context.on('response', on_response)
+        return seen, all_ready, on_response
     
-    async def _wait_for_key_cookies(self, context, timeout=5):
+    async def _wait_for_key_cookies(self, context, watch, timeout=5):
         """
         等待必須的 cookies 生成
         必須的 cookies: _abck, bm_sz, bm_sv（Akamai Bot Manager 反機器人系統）
         
+        以 _watch_set_cookies 的監聽結果判斷，所有必須的 cookies 在本次會話中下發後立即返回，
+        不再每 0.5 秒輪詢一次 context.cookies()
+        
         Args:
             context: Playwright context
+            watch: _watch_set_cookies 的返回值
             timeout: 最長等待時間（秒）
         
         Returns:
             tuple: (是否成功, 缺失的 cookies 列表)
         """
-        required_cookies = ['_abck', 'bm_sz', 'bm_sv']
-        start_time = asyncio.get_event_loop().time()
-        
-        while asyncio.get_event_loop().time() - start_time < timeout:
-            cookies = await context.cookies()
-            cookie_names = {c['name'] for c in cookies}
-            
-            # 檢查哪些必須的 cookies 已經生成
-            missing = [key for key in required_cookies if key not in cookie_names]
-            
-            if not missing:  # 所有必須的 cookies 都已生成
-                return True, []
-            
-            await asyncio.sleep(0.5)  # 每0.5秒檢查一次
+        _seen, all_ready, on_response = watch
+        try:
+            await asyncio.wait_for(all_ready.wait(), timeout=timeout)
+            return True, []
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            context.remove_listener('response', on_response)
         
-        # 超時後返回缺失的 cookies
+        # 超時後以實際的 cookies 確認（部分 cookies 可能由頁面腳本直接寫入）
         cookies = await context.cookies()
         cookie_names = {c['name'] for c in cookies}
-        missing = [key for key in required_cookies if key not in cookie_names]
-        return False, missing
+        missing = [key for key in self.REQUIRED_COOKIES if key not in cookie_names]
+        return not missing, missing
     
     async def fetch_cookies_async(self, headless=False, wait_time=10):
         """
@@ -66,26 +101,27 @@ class CookieFetcher:
         print(f"[CookieFetcher] 模式: {'無頭' if headless else '有頭（顯示窗口）'}")
         
         async with async_playwright() as p:
-            browser = None
+            context = None
             try:
-                # 啟動瀏覽器（有頭模式更容易通過檢測）
-                browser = await p.chromium.launch(
+                # 以持久化設定檔啟動瀏覽器（有頭模式更容易通過檢測）
+                # 重用設定檔可沿用上次的反機器人驗證狀態，第二次起通常更快取得有效 cookies
+                context = await p.chromium.launch_persistent_context(
+                    user_data_dir=self.profile_dir,
                     headless=headless,
                     args=[
                         '--disable-blink-features=AutomationControlled',
                         '--disable-dev-shm-usage',
-                    ]
-                )
-                
-                # 創建 context
-                context = await browser.new_context(
+                    ],
                     user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:146.0) Gecko/20100101 Firefox/146.0',
                     viewport={'width': 1920, 'height': 1080},
                     locale='zh-TW',
                 )
                 
-                # 創建頁面
-                page = await context.new_page()
+                # 訪問頁面前就開始監聽 Set-Cookie，確保捕捉到本次重新下發的 cookies
+                cookie_watch = self._watch_set_cookies(context)
+                
+                # 使用持久化 context 預設開啟的頁面
+                page = context.pages[0] if context.pages else await context.new_page()
                 
                 # 應用 stealth
                 stealth = Stealth()
@@ -102,7 +138,7 @@ class CookieFetcher:
                     
                     # 等待必須的 cookies 生成
                     print(f"[CookieFetcher] 等待必須的 cookies 生成...")
-                    cookies_ready, missing = await self._wait_for_key_cookies(context, timeout=wait_time)
+                    cookies_ready, missing = await self._wait_for_key_cookies(context, cookie_watch, timeout=wait_time)
                     
                     if cookies_ready:
                         print(f"[CookieFetcher] ✓ 所有必須的 cookies 已生成 (_abck, bm_sz, bm_sv)")
@@ -129,14 +165,14 @@ class CookieFetcher:
                     if status == 200:
                         print(f"[CookieFetcher] ✅ 成功！API 返回 200")
                         
-                        # 嘗試解析 JSON
+                        # 直接檢查原始回應內容（不經 DOM 序列化，避免整頁 HTML 跨 IPC 傳輸）
                         try:
-                            content = await page.content()
-                            if 'conversionRate' in content:
+                            body = await response.body()
+                            if body.find(b'conversionRate') != -1:
                                 print(f"[CookieFetcher] ✓ 確認：頁面包含匯率數據")
                                 api_success = True
                         except Exception as e:
-                            print(f"[CookieFetcher] 解析頁面內容時發生錯誤: {e}")
+                            print(f"[CookieFetcher] 讀取回應內容時發生錯誤: {e}")
                     else:
                         print(f"[CookieFetcher] ⚠️ API 返回 {status}")
                     
@@ -184,8 +220,8 @@ class CookieFetcher:
                 return cookies
             
             finally:
-                if browser:
-                    await browser.close()
+                if context:
+                    await context.close()
                     print("[CookieFetcher] 瀏覽器已關閉")
     
     def fetch_cookies(self, headless=False, wait_time=10):
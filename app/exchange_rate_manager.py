@@ -7,13 +7,13 @@ import logging
 import requests
 import matplotlib.pyplot as plt
 from datetime import datetime, timedelta
-from threading import Lock, Thread
+from threading import Lock, Thread, Event
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import concurrent.futures
 from matplotlib.ticker import MaxNLocator, FuncFormatter
 from flask import current_app
 
-from .utils import LRUCache, RateLimiter
+from .utils import LRUCache, RateLimiter, load_json_cached, save_json_compact
 from .sse import send_sse_event
 
 logger = logging.getLogger(__name__)
@@ -22,10 +22,22 @@ logger = logging.getLogger(__name__)
 DATA_FILE = 'TWD-HKD_180d.json'
 rate_limiter = RateLimiter(max_requests_per_second=5)
 
+# 圖表樣式版本：寫入圖表檔名的雜湊中，修改繪圖樣式時遞增，避免沿用舊樣式的已生成圖表
+CHART_STYLE_VERSION = 1
+
+# 字體設定完成的事件（由 create_app 的背景執行緒設定），圖表生成前需等待
+fonts_ready = Event()
+
 
 class ExchangeRateManager:
-    def __init__(self):
-        self.data = self.load_data()
+    def __init__(self, preloaded_data=None):
+        # 啟動流程已讀取過數據文件時直接沿用，避免重複讀取與解析
+        self._data_mtime = None
+        if preloaded_data is not None:
+            self.data = preloaded_data
+            self._data_mtime = self._stat_data_file()
+        else:
+            self.data = self.load_data()
         self._network_paused = False
         self._pause_until = 0
         self._pause_lock = Lock()
@@ -54,22 +66,58 @@ class ExchangeRateManager:
         self._shared_scraper = None
         self._scraper_lock = Lock()
 
+    @staticmethod
+    def _stat_data_file():
+        """返回數據文件的 (mtime_ns, size)，文件不存在時返回 None"""
+        try:
+            st = os.stat(DATA_FILE)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
     def load_data(self):
         """載入本地數據"""
         if os.path.exists(DATA_FILE):
             try:
-                with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except (json.JSONDecodeError, IOError) as e:
-                logger.error(f"載入數據時發生錯誤: {e}", exc_info=True)
+                self._data_mtime = self._stat_data_file()
+                return load_json_cached(DATA_FILE)
+            except (json.JSONDecodeError, IOError):
+                logger.exception("載入數據時發生錯誤")
                 return {}
         return {}
 
     def save_data(self):
         """保存數據到本地"""
         with self.data_lock:
-            with open(DATA_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.data, f, ensure_ascii=False, indent=2)
+            save_json_compact(DATA_FILE, self.data)
+            self._data_mtime = self._stat_data_file()
+
+    def reload_data_if_changed(self):
+        """數據文件有變更（mtime 或大小不同）時才重新載入
+
+        Returns:
+            bool: 是否重新載入了數據
+        """
+        current = self._stat_data_file()
+        if current is not None and current == self._data_mtime:
+            return False
+        self.data = self.load_data()
+        return True
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        # 每次替換數據時同步記錄最新日期，查詢時不必再掃描或排序所有日期
+        self._data = value
+        self._latest_date_str = max(value) if value else None
+
+    @property
+    def latest_date_str(self):
+        """數據中的最新日期（YYYY-MM-DD），無數據時為 None"""
+        return self._latest_date_str
 
     def get_sorted_dates(self):
         """獲取排序後的日期列表"""
@@ -156,8 +204,8 @@ class ExchangeRateManager:
         
         print(f"🔍 開始清理 {days} 天以外的舊數據...")
         
-        # 重新載入數據（可能已被外部腳本更新）
-        self.data = self.load_data()
+        # 數據文件有變更時才重新載入（可能已被排程或外部腳本更新）
+        self.reload_data_if_changed()
         
         # 清理超過指定天數的舊數據
         old_count = len(self.data)
@@ -175,8 +223,7 @@ class ExchangeRateManager:
         
         # 顯示數據狀態
         if self.data:
-            latest_date_str = max(self.data.keys())
-            print(f"📅 數據中最新日期：{latest_date_str}")
+            print(f"📅 數據中最新日期：{self.latest_date_str}")
             print(f"📊 當前數據量：{len(self.data)} 筆")
         else:
             print(f"⚠️ 沒有本地數據，請運行：python update_twd_hkd_data.py")
@@ -547,23 +594,21 @@ class ExchangeRateManager:
                 # 對於 TWD-HKD，額外檢查數據是否有更新
                 if buy_currency == 'TWD' and sell_currency == 'HKD':
                     # 檢查數據文件的最新日期
-                    if self.data:
-                        sorted_dates = self.get_sorted_dates()
-                        if sorted_dates:
-                            latest_data_date = sorted_dates[-1]
-                            # 從圖表 URL 提取日期（格式：chart_TWD-HKD_180d_2025-12-17_hash.png）
-                            url_parts = chart_url.split('_')
-                            if len(url_parts) >= 4:
-                                cached_date = url_parts[3]  # 2025-12-17
-                                # 如果數據更新了，清除快取重新生成
-                                if latest_data_date > cached_date:
-                                    print(f"🔄 檢測到數據更新（{cached_date} -> {latest_data_date}），重新生成圖表")
-                                    with self.lru_cache.lock:
-                                        if cache_key in self.lru_cache.cache:
-                                            del self.lru_cache.cache[cache_key]
-                                        if cache_key in self.lru_cache.access_order:
-                                            self.lru_cache.access_order.remove(cache_key)
-                                    cached_info = None
+                    latest_data_date = self.latest_date_str
+                    if latest_data_date:
+                        # 從圖表 URL 提取日期（格式：chart_TWD-HKD_180d_2025-12-17_hash.png）
+                        url_parts = chart_url.split('_')
+                        if len(url_parts) >= 4:
+                            cached_date = url_parts[3]  # 2025-12-17
+                            # 如果數據更新了，清除快取重新生成
+                            if latest_data_date > cached_date:
+                                print(f"🔄 檢測到數據更新（{cached_date} -> {latest_data_date}），重新生成圖表")
+                                with self.lru_cache.lock:
+                                    if cache_key in self.lru_cache.cache:
+                                        del self.lru_cache.cache[cache_key]
+                                    if cache_key in self.lru_cache.access_order:
+                                        self.lru_cache.access_order.remove(cache_key)
+                                cached_info = None
                 
                 if cached_info:
                     return cached_info
@@ -681,7 +726,7 @@ class ExchangeRateManager:
         data_count = len(all_dates_str)
         
         # 輕量級雜湊字串：只使用關鍵資訊確保唯一性
-        data_str = f"{days}-{buy_currency}-{sell_currency}-{first_date_str}-{latest_date_str}-{data_count}-{first_rate}-{last_rate}"
+        data_str = f"v{CHART_STYLE_VERSION}-{days}-{buy_currency}-{sell_currency}-{first_date_str}-{latest_date_str}-{data_count}-{first_rate}-{last_rate}"
         chart_hash = hashlib.md5(data_str.encode('utf-8')).hexdigest()
         filename = f"chart_{buy_currency}-{sell_currency}_{days}d_{latest_date_str}_{chart_hash[:8]}.png"
 
@@ -691,6 +736,9 @@ class ExchangeRateManager:
         if os.path.exists(full_path):
             return f"/static/{relative_path.replace(os.path.sep, '/')}"
 
+        # 等待背景字體設定完成，避免以預設字體生成（並快取）缺字的圖表
+        fonts_ready.wait(timeout=30)
+
         # 創建圖表
         fig, ax = plt.subplots(figsize=(15, 8.5))
         
@@ -825,8 +873,12 @@ class ExchangeRateManager:
         為常用週期預熱圖表快取。
         此函數只提交任務，不阻塞。
         會根據貨幣對類型選擇不同的執行策略。
+
+        Returns:
+            list: 本次提交的背景任務 Future，呼叫端可用來得知預熱何時完成
         """
         flask_app = current_app._get_current_object()
+        futures = []
 
         # 策略一：對於 TWD-HKD，我們有本地數據，可以直接生成圖表並通知
         if buy_currency == 'TWD' and sell_currency == 'HKD':
@@ -857,7 +909,7 @@ class ExchangeRateManager:
                                 'sell_currency': sell_currency, 'period': period
                             })
                 
-                self.background_executor.submit(generate_and_notify, self, period, flask_app)
+                futures.append(self.background_executor.submit(generate_and_notify, self, period, flask_app))
 
         # 策略二：對於其他貨幣對，我們需要先抓取數據，然後再生成圖表
         else:
@@ -866,10 +918,12 @@ class ExchangeRateManager:
                     print(f"🌀 {buy_currency}-{sell_currency} 的背景抓取任務已啟動...")
                     self._active_fetches.add((buy_currency, sell_currency))
                     # 提交的是 _background_fetch_and_generate 任務，並傳遞 flask_app
-                    self.background_executor.submit(self._background_fetch_and_generate, buy_currency, sell_currency, flask_app)
+                    futures.append(self.background_executor.submit(self._background_fetch_and_generate, buy_currency, sell_currency, flask_app))
                 else:
                     print(f"✅ {buy_currency}-{sell_currency} 的背景抓取已在進行中，無需重複啟動。")
 
+        return futures
+
     @staticmethod
     def _cleanup_charts_directory(directory, max_age_days=1):
         """清理超過指定天數的舊圖表檔案"""
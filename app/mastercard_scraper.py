@@ -4,10 +4,17 @@ Mastercard 數據抓取器 - 使用真實瀏覽器會話
 """
 
 import json
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
 from datetime import datetime, timedelta
-import time
-import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .utils import RateLimiter, save_json_compact, collect_missing_workdays
+
+# 所有 scraper 共用的全域速率限制（取代每次請求前的隨機延遲，不受並發 worker 數影響）
+rate_limiter = RateLimiter(max_requests_per_second=10)
 
 
 class MastercardScraper:
@@ -15,33 +22,111 @@ class MastercardScraper:
     使用 requests + 有效 cookies 的方式抓取 Mastercard 數據
     """
     
+    API_URL = "https://www.mastercard.com/marketingservices/public/mccom-services/currency-conversions/conversion-rates"
+    
+    # 每次請求都相同的查詢參數
+    BASE_PARAMS = {
+        'bank_fee': '0',
+        'transaction_amount': '1'
+    }
+    
+    # 從 HAR 提取的完整 headers（在 __init__ 中設為 Session 預設值，不需每次請求重建）
+    # Accept-Encoding 只宣告 urllib3 能解碼的格式（br/zstd 取決於是否安裝對應套件）
+    DEFAULT_HEADERS = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:146.0) Gecko/20100101 Firefox/146.0',
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+        'Accept-Language': 'zh-TW,zh-HK;q=0.8,zh;q=0.6,en-US;q=0.4,en;q=0.2',
+        'Accept-Encoding': ACCEPT_ENCODING,
+        'DNT': '1',
+        'Sec-GPC': '1',
+        'Connection': 'keep-alive',
+        'Upgrade-Insecure-Requests': '1',
+        'Sec-Fetch-Dest': 'document',
+        'Sec-Fetch-Mode': 'navigate',
+        'Sec-Fetch-Site': 'none',
+        'Sec-Fetch-User': '?1',
+        'Priority': 'u=0, i',
+        'TE': 'trailers'
+    }
+    
     def __init__(self, cookies_file='mastercard_cookies.json'):
         self.cookies_file = cookies_file
-        self.session = None
-        self.cookies_dict = {}
-        self.load_cookies()
+        
+        # 共用 Session：保持連線（keep-alive）並重用 TCP/TLS 連線
+        # 連線池大小與並發抓取的 worker 數一致，避免連線被丟棄重建
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=12))
+        self.session.headers.update(self.DEFAULT_HEADERS)
+        self.reload_cookies()
     
     def load_cookies(self):
-        """從文件載入 cookies"""
+        """
+        從文件讀取 cookies（只解析文件，不修改 Session）
+        
+        Returns:
+            list: cookie 列表；文件不存在或格式錯誤時返回 None
+        """
         try:
             with open(self.cookies_file, 'r', encoding='utf-8') as f:
-                cookies_list = json.load(f)
-            
-            # 轉換為 requests 需要的格式
-            self.cookies_dict = {
-                cookie['name']: cookie['value'] 
-                for cookie in cookies_list
-            }
-            
-            print(f"[Scraper] ✓ 已載入 {len(self.cookies_dict)} 個 cookies")
-            return True
+                return json.load(f)
         except FileNotFoundError:
             print(f"[Scraper] 錯誤：找不到 {self.cookies_file}")
             print("[Scraper] 請先手動使用瀏覽器訪問 Mastercard 並導出 cookies")
-            return False
+            return None
         except Exception as e:
             print(f"[Scraper] 載入 cookies 時發生錯誤: {e}")
+            return None
+    
+    def reload_cookies(self):
+        """
+        從文件重新載入 cookies 並寫入 Session 的 cookie jar
+        
+        只替換 cookie jar，保留既有的 Session 與連線池（keep-alive 的 TCP/TLS 連線），
+        Cookies 刷新後直接在同一個實例上呼叫即可。
+        
+        Returns:
+            bool: 是否載入成功
+        """
+        cookies_list = self.load_cookies()
+        if cookies_list is None:
             return False
+        
+        # 一次性寫入 Session 的 cookie jar，之後每次請求直接沿用
+        self.session.cookies.clear()
+        for cookie in cookies_list:
+            self.session.cookies.set(
+                cookie['name'],
+                cookie['value'],
+                domain=cookie.get('domain', '.mastercard.com'),
+                path=cookie.get('path', '/')
+            )
+        
+        print(f"[Scraper] ✓ 已載入 {len(cookies_list)} 個 cookies")
+        return True
+    
+    def validate_cookies(self):
+        """
+        以輕量的 HEAD 請求檢查目前的 cookies 是否仍有效
+        
+        只在抓取全部以連線錯誤或逾時失敗（沒有任何 HTTP 回應可判斷）時使用；
+        GET 回應的 401/403 已足以確定 cookies 失效，不需再探測。
+        只有 401/403 才視為 cookies 失效；網路錯誤等暫時性問題不值得重新啟動瀏覽器。
+        
+        Returns:
+            bool: cookies 是否有效
+        """
+        try:
+            rate_limiter.wait_if_needed()
+            response = self.session.head(self.API_URL, timeout=5)
+        except Exception as e:
+            print(f"[Scraper] 驗證 cookies 時發生網路錯誤: {e}")
+            return True
+        
+        if response.status_code in (401, 403):
+            print(f"[Scraper] ✗ Cookies 已失效 (HTTP {response.status_code})")
+            return False
+        
+        return True
     
     def get_exchange_rate(self, date, buy_currency='TWD', sell_currency='HKD'):
         """
@@ -55,51 +140,27 @@ class MastercardScraper:
         Returns:
             dict: {'data': {'conversionRate': '0.251241', ...}} 或 None
         """
-        url = "https://www.mastercard.com/marketingservices/public/mccom-services/currency-conversions/conversion-rates"
+        date_str = date.strftime('%Y-%m-%d')
         
         params = {
-            'exchange_date': date.strftime('%Y-%m-%d'),
+            **self.BASE_PARAMS,
+            'exchange_date': date_str,
             'transaction_currency': buy_currency,
-            'cardholder_billing_currency': sell_currency,
-            'bank_fee': '0',
-            'transaction_amount': '1'
-        }
-        
-        # 從 HAR 提取的完整 headers
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:146.0) Gecko/20100101 Firefox/146.0',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-            'Accept-Language': 'zh-TW,zh-HK;q=0.8,zh;q=0.6,en-US;q=0.4,en;q=0.2',
-            'Accept-Encoding': 'gzip, deflate, br, zstd',
-            'DNT': '1',
-            'Sec-GPC': '1',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-            'Sec-Fetch-Dest': 'document',
-            'Sec-Fetch-Mode': 'navigate',
-            'Sec-Fetch-Site': 'none',
-            'Sec-Fetch-User': '?1',
-            'Priority': 'u=0, i',
-            'TE': 'trailers'
+            'cardholder_billing_currency': sell_currency
         }
         
-        date_str = date.strftime('%Y-%m-%d')
-        
         try:
-            # 添加隨機延遲
-            delay = random.uniform(0.5, 1.0)
-            time.sleep(delay)
+            # 全域速率限制
+            rate_limiter.wait_if_needed()
             
-            response = requests.get(
-                url,
+            response = self.session.get(
+                self.API_URL,
                 params=params,
-                headers=headers,
-                cookies=self.cookies_dict,
                 timeout=15
             )
             
             if response.status_code == 200:
-                data = response.json()
+                data = orjson.loads(response.content)
                 print(f"[Scraper] ✓ {date_str}")
                 return data
             elif response.status_code == 403:
@@ -108,7 +169,7 @@ class MastercardScraper:
             elif response.status_code == 400:
                 # 檢查是否是「數據不存在」的錯誤（錯誤碼 114）
                 try:
-                    error_data = response.json()
+                    error_data = orjson.loads(response.content)
                     error_code = error_data.get('data', {}).get('errorCode')
                     if error_code == '114':
                         # 錯誤碼 114 表示該日期沒有匯率數據（正常情況，不顯示）
@@ -160,52 +221,59 @@ class MastercardScraper:
         # 找到最新的日期
         if data:
             latest_date_str = max(data.keys())
-            latest_date = datetime.strptime(latest_date_str, '%Y-%m-%d')
+            latest_date = datetime.fromisoformat(latest_date_str)
             start_date = latest_date + timedelta(days=1)
             print(f"[Scraper] 最新數據: {latest_date_str}")
         
         print(f"[Scraper] 需要更新從 {start_date.strftime('%Y-%m-%d')} 到 {end_date.strftime('%Y-%m-%d')}")
         
-        # 抓取數據
+        # 先一次性收集缺少的工作日（跳過週末與已有數據）
+        dates_to_fetch = collect_missing_workdays(data, start_date, end_date)
+        
+        # 並發抓取數據
         updated_count = 0
-        current_date = start_date
+        stopped = False
+        # 本次更新的批次時間戳（所有新數據共用）
+        batch_ts = datetime.now().isoformat()
         
-        while current_date <= end_date:
-            # 跳過週末
-            if current_date.weekday() < 5:
-                date_str = current_date.strftime('%Y-%m-%d')
+        with ThreadPoolExecutor(max_workers=6, thread_name_prefix='ScraperFetch') as executor:
+            future_to_date = {
+                executor.submit(self.get_exchange_rate, d, 'TWD', 'HKD'): ds
+                for d, ds in dates_to_fetch
+            }
+            
+            for future in as_completed(future_to_date):
+                # 已取消的任務直接略過；取消前已在執行中的請求仍會完成，其結果照常保存
+                if future.cancelled():
+                    continue
                 
-                # 如果已經有數據，跳過
-                if date_str in data:
-                    print(f"[Scraper] {date_str} 已存在，跳過")
+                date_str = future_to_date[future]
+                result = future.result()
+                
+                if result and 'data' in result:
+                    try:
+                        rate = float(result['data']['conversionRate'])
+                        data[date_str] = {
+                            'rate': rate,
+                            'updated': batch_ts
+                        }
+                        updated_count += 1
+                        print(f"[Scraper] ✓ {date_str}: {rate}")
+                    except Exception as e:
+                        print(f"[Scraper] ✗ {date_str}: 解析失敗 - {e}")
                 else:
-                    result = self.get_exchange_rate(current_date, 'TWD', 'HKD')
+                    print(f"[Scraper] ✗ {date_str}: 獲取失敗")
                     
-                    if result and 'data' in result:
-                        try:
-                            rate = float(result['data']['conversionRate'])
-                            data[date_str] = {
-                                'rate': rate,
-                                'updated': datetime.now().isoformat()
-                            }
-                            updated_count += 1
-                            print(f"[Scraper] ✓ {date_str}: {rate}")
-                        except Exception as e:
-                            print(f"[Scraper] ✗ {date_str}: 解析失敗 - {e}")
-                    else:
-                        print(f"[Scraper] ✗ {date_str}: 獲取失敗")
-                        
-                        # 如果是 403，停止更新
-                        if result is None:
-                            print(f"[Scraper] 停止更新（可能需要刷新 cookies）")
-                            break
-            
-            current_date += timedelta(days=1)
+                    # 如果請求發生錯誤，取消尚未開始的任務
+                    if result is None and not stopped:
+                        stopped = True
+                        print(f"[Scraper] 停止更新（可能需要刷新 cookies）")
+                        for f in future_to_date:
+                            f.cancel()
         
         # 保存數據
         if updated_count > 0:
-            with open(data_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            save_json_compact(data_file, data)
             print(f"[Scraper] 已保存 {updated_count} 條新數據到 {data_file}")
         else:
             print(f"[Scraper] 沒有新數據需要保存")
@@ -2,11 +2,10 @@ from flask import Blueprint, render_template, request, jsonify, Response, curren
 from datetime import datetime
 import time
 import queue
-import schedule
 import uuid
 
-from .sse import sse_clients, sse_lock, sse_stream
-from .scheduler import scheduled_update
+from .sse import sse_clients, sse_lock, sse_stream, format_sse_event
+from .scheduler import scheduled_update, get_next_run_time
 from .utils import validate_currency_code, validate_period
 
 bp = Blueprint('main', __name__)
@@ -147,16 +146,13 @@ def server_status_api():
 def get_schedule_status():
     """獲取定時任務狀態API"""
     try:
-        jobs = schedule.jobs
-        next_run_time = None
-
-        if jobs:
-            next_run_time = min(job.next_run for job in jobs).strftime('%Y-%m-%d %H:%M:%S')
+        next_run = get_next_run_time()
+        next_run_time = next_run.strftime('%Y-%m-%d %H:%M:%S') if next_run else None
 
         return jsonify({
             'success': True,
             'data': {
-                'is_active': len(jobs) > 0,
+                'is_active': next_run is not None,
                 'next_run_time': next_run_time,
                 'scheduled_time': '每天 09:00',
                 'current_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -172,10 +168,18 @@ def get_schedule_status():
 def trigger_scheduled_update():
     """手動觸發定時更新API"""
     try:
-        scheduled_update()
+        result = scheduled_update(current_app._get_current_object())
+        messages = {
+            'updated': '定時更新已手動觸發完成',
+            'not_updated': '定時更新已執行，但尚無最新工作日的匯率資料',
+            'skipped_running': '定時更新正在執行中，本次觸發已略過',
+            'skipped_throttled': '今天的數據剛更新過，本次觸發已略過'
+        }
         return jsonify({
             'success': True,
-            'message': '定時更新已手動觸發完成'
+            'status': result,
+            'skipped': result.startswith('skipped'),
+            'message': messages.get(result, '定時更新已手動觸發完成')
         })
     except Exception as e:
         return jsonify({
@@ -266,7 +270,7 @@ def sse_events():
     print(f"[SSE] 新客戶端連接，目前連接數: {len(sse_clients)}")
 
     try:
-        client_queue.put("event: connected\ndata: {\"message\": \"SSE連接已建立\"}\n\n", timeout=1)
+        client_queue.put(format_sse_event('connected', {'message': 'SSE連接已建立'}), timeout=1)
     except queue.Full:
         pass
 
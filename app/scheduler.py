@@ -1,19 +1,47 @@
-import schedule
+import sched
+import itertools
 import time
 import json
 import os
 import logging
 from datetime import datetime, timedelta
-from threading import Thread
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Thread, Lock, Event
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from .sse import send_sse_event
+from .utils import load_json_cached, save_json_compact, collect_missing_workdays
 
 logger = logging.getLogger(__name__)
-_app = None
 
 DATA_FILE = 'TWD-HKD_180d.json'
 COOKIES_FILE = 'mastercard_cookies.json'
 
+# 維護任務的執行間隔（對齊整點與半點），以及每日更新所在的小時
+MAINTENANCE_INTERVAL = 1800
+UPDATE_HOUR = 9
+
+# 排程執行緒的停止信號與執行緒實例（供程式關閉時喚醒並等待）
+_stop = Event()
+_scheduler_thread = None
+
+# 標準庫的事件排程器：使用 monotonic 時鐘，系統校時（NTP）造成的時間跳動不會導致漏跑或重跑；
+# 等待時使用 _stop.wait，收到停止信號時可立即醒來
+_scheduler = sched.scheduler(time.monotonic, _stop.wait)
+_job_seq = itertools.count()
+
+# 到期的任務交給單一工作執行緒執行，排程執行緒只負責計時與派發；
+# 上一次執行尚未結束時略過本次，避免到期的維護任務在工作執行緒後面排隊累積
+_job_pool = None
+_job_futures = {}  # 任務序號 -> 最近一次執行的 Future
+
+# rate_updated 事件的固定欄位：排程只更新 TWD-HKD，前端依貨幣對判斷是否需要重新載入
+_RATE_UPDATED_BASE = {'buy_currency': 'TWD', 'sell_currency': 'HKD'}
+
+# 排程更新的互斥鎖與去重紀錄（同一天成功更新後的節流時間）
+UPDATE_THROTTLE_SECONDS = 60
+_update_lock = Lock()
+_last_update = {'date': None, 'ts': 0.0}
+_update_failures = 0  # 排程更新連續失敗的次數
+
 
 def _fetch_missing_data():
     """檢查缺少的日期並從 Mastercard API 抓取
@@ -33,10 +61,9 @@ def _fetch_missing_data():
 
     # 載入本地數據
     try:
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            local_data = json.load(f)
+        local_data = load_json_cached(DATA_FILE)
     except (FileNotFoundError, json.JSONDecodeError, IOError) as e:
-        logger.warning(f"載入本地數據失敗: {e}")
+        logger.warning("載入本地數據失敗: %s", e)
         local_data = {}
 
     # 找出應該有數據的最新工作日
@@ -49,10 +76,10 @@ def _fetch_missing_data():
 
     # 檢查是否需要更新
     if expected_date_str in local_data:
-        logger.info(f"✅ 本地數據已是最新（{expected_date_str}）")
+        logger.info("✅ 本地數據已是最新（%s）", expected_date_str)
         return True
 
-    logger.info(f"⚠️ 需要更新數據（缺少 {expected_date_str}）")
+    logger.info("⚠️ 需要更新數據（缺少 %s）", expected_date_str)
 
     # 檢查 cookies 是否存在
     if not os.path.exists(COOKIES_FILE):
@@ -64,7 +91,7 @@ def _fetch_missing_data():
                 logger.error("❌ 無法自動獲取 cookies")
                 return False
         except Exception as e:
-            logger.error(f"❌ 獲取 cookies 時發生錯誤: {e}")
+            logger.error("❌ 獲取 cookies 時發生錯誤: %s", e)
             return False
 
     # 使用 scraper 更新數據
@@ -75,126 +102,155 @@ def _fetch_missing_data():
         # 找出需要更新的日期範圍
         if local_data:
             latest_date_str = max(local_data.keys())
-            latest_date = datetime.strptime(latest_date_str, '%Y-%m-%d')
-            logger.info(f"   本地最新數據：{latest_date_str}")
+            latest_date = datetime.fromisoformat(latest_date_str)
+            logger.info("   本地最新數據：%s", latest_date_str)
         else:
             latest_date = today - timedelta(days=181)
             logger.info("   本地無數據，將獲取最近 180 天")
 
         # 收集需要更新的日期（排除週末和已有數據）
-        start_fetch_date = latest_date + timedelta(days=1)
-        dates_to_fetch = []
-        current_date = start_fetch_date
-        while current_date <= today:
-            if current_date.weekday() < 5:  # 只更新工作日
-                date_str = current_date.strftime('%Y-%m-%d')
-                if date_str not in local_data:
-                    dates_to_fetch.append(current_date)
-            current_date += timedelta(days=1)
+        dates_to_fetch = collect_missing_workdays(local_data, latest_date + timedelta(days=1), today)
 
         if not dates_to_fetch:
             logger.info("✅ 數據已是最新，無需更新")
             return True
 
-        logger.info(f"🚀 開始並發抓取 {len(dates_to_fetch)} 個日期的數據...")
+        logger.info("🚀 開始並發抓取 %d 個日期的數據...", len(dates_to_fetch))
 
         # 定義單個日期的抓取函數
-        def fetch_single_date(date_obj):
+        def fetch_single_date(date_obj, date_str):
             try:
                 data = scraper.get_exchange_rate(date_obj)
-                date_str = date_obj.strftime('%Y-%m-%d')
+                status = data.get('status_code') if data else None
 
                 if data and 'data' in data and 'conversionRate' in data['data']:
                     try:
                         rate = float(data['data']['conversionRate'])
-                        return (date_str, rate, None)
+                        return (date_str, rate, None, status)
                     except (KeyError, ValueError) as e:
-                        return (date_str, None, f"解析失敗: {e}")
+                        return (date_str, None, f"解析失敗: {e}", status)
                 else:
-                    return (date_str, None, "API 未返回有效數據")
+                    error = f"API 未返回有效數據 (HTTP {status})" if status else "API 未返回有效數據"
+                    return (date_str, None, error, status)
             except Exception as e:
-                return (date_obj.strftime('%Y-%m-%d'), None, f"請求失敗: {e}")
+                return (date_str, None, f"請求失敗: {e}", None)
 
         # 並發抓取數據
         updated_count = 0
         failed_count = 0
+        auth_failed = False  # 是否有請求回應 401/403（cookies 失效）
+        got_response = False  # 是否有請求收到其他 HTTP 錯誤回應
+        # 本次更新的批次時間戳（所有新數據共用）
+        batch_ts = datetime.now().isoformat()
 
         with ThreadPoolExecutor(max_workers=12, thread_name_prefix='ScheduledFetch') as executor:
-            future_to_date = {executor.submit(fetch_single_date, d): d for d in dates_to_fetch}
+            future_to_date = {executor.submit(fetch_single_date, d, ds): d for d, ds in dates_to_fetch}
 
             for future in as_completed(future_to_date):
-                date_str, rate, error = future.result()
+                date_str, rate, error, status = future.result()
 
                 if rate is not None:
                     local_data[date_str] = {
                         'rate': rate,
-                        'updated': datetime.now().isoformat()
+                        'updated': batch_ts
                     }
-                    logger.info(f"   ✅ {date_str}: {rate}")
+                    logger.info("   ✅ %s: %s", date_str, rate)
                     updated_count += 1
                 else:
-                    logger.warning(f"   ❌ {date_str}: {error}")
+                    logger.warning("   ❌ %s: %s", date_str, error)
                     failed_count += 1
-
-        # 如果全部失敗，嘗試自動刷新 Cookies 並重試
-        if failed_count > 0 and updated_count == 0:
-            logger.warning("⚠️ 所有請求都失敗了，可能是 cookies 過期")
+                    if status in (401, 403):
+                        auth_failed = True
+                    elif status is not None:
+                        got_response = True
+
+        # 如果全部失敗且 cookies 已過期，嘗試自動刷新 Cookies 並重試
+        # GET 回應 401/403 即確定失效；所有失敗都是連線錯誤或逾時時，才以 HEAD 請求探測
+        all_failed = failed_count > 0 and updated_count == 0
+        cookies_expired = all_failed and (
+            auth_failed or (not got_response and not scraper.validate_cookies())
+        )
+        if all_failed and not cookies_expired:
+            logger.warning("⚠️ 所有請求都失敗了，但並非 Cookies 失效（可能是暫時性問題），略過重新獲取")
+        elif cookies_expired:
+            logger.warning("⚠️ 所有請求都失敗了，cookies 已過期")
             logger.info("🍪 嘗試自動重新獲取 Cookies...")
             try:
                 fetcher = CookieFetcher(COOKIES_FILE)
                 success = fetcher.fetch_and_save(headless=False, wait_time=10)
                 if success:
                     logger.info("✅ Cookies 更新成功，正在重新嘗試抓取數據...")
-                    scraper.load_cookies()
+                    scraper.reload_cookies()
 
                     updated_count = 0
                     failed_count = 0
 
                     with ThreadPoolExecutor(max_workers=12, thread_name_prefix='RetryFetch') as executor:
-                        future_to_date = {executor.submit(fetch_single_date, d): d for d in dates_to_fetch}
+                        future_to_date = {executor.submit(fetch_single_date, d, ds): d for d, ds in dates_to_fetch}
 
                         for future in as_completed(future_to_date):
-                            date_str, rate, error = future.result()
+                            date_str, rate, error, status = future.result()
 
                             if rate is not None:
                                 local_data[date_str] = {
                                     'rate': rate,
-                                    'updated': datetime.now().isoformat()
+                                    'updated': batch_ts
                                 }
-                                logger.info(f"   ✅ {date_str}: {rate}")
+                                logger.info("   ✅ %s: %s", date_str, rate)
                                 updated_count += 1
                             else:
-                                logger.warning(f"   ❌ {date_str}: {error}")
+                                logger.warning("   ❌ %s: %s", date_str, error)
                                 failed_count += 1
 
                     if updated_count > 0:
-                        logger.info(f"🎉 使用新 Cookies 成功獲取 {updated_count} 筆數據")
+                        logger.info("🎉 使用新 Cookies 成功獲取 %d 筆數據", updated_count)
                     else:
                         logger.warning("⚠️ 使用新 Cookies 仍然無法獲取數據")
                 else:
                     logger.error("❌ 無法重新獲取 cookies")
             except Exception as e:
-                logger.error(f"❌ 重新獲取 cookies 時發生錯誤: {e}")
+                logger.error("❌ 重新獲取 cookies 時發生錯誤: %s", e)
 
         # 保存更新的數據
         if updated_count > 0:
             sorted_data = dict(sorted(local_data.items(), key=lambda x: x[0]))
-            with open(DATA_FILE, 'w', encoding='utf-8') as f:
-                json.dump(sorted_data, f, ensure_ascii=False, indent=2)
-            logger.info(f"💾 已保存 {updated_count} 筆新數據到 {DATA_FILE}")
+            save_json_compact(DATA_FILE, sorted_data)
+            logger.info("💾 已保存 %d 筆新數據到 %s", updated_count, DATA_FILE)
             if failed_count > 0:
-                logger.info(f"⚠️ 有 {failed_count} 筆數據獲取失敗")
+                logger.info("⚠️ 有 %d 筆數據獲取失敗", failed_count)
             return True
         else:
             logger.warning("⚠️ 沒有獲取到新數據")
             return False
 
-    except Exception as e:
-        logger.error(f"❌ 更新數據時發生錯誤: {e}", exc_info=True)
+    except Exception:
+        logger.exception("❌ 更新數據時發生錯誤")
         return False
 
 
-def scheduled_update():
+def _notify_when_charts_ready(futures, date_str):
+    """所有圖表預熱任務完成後發送 charts_ready 事件
+
+    以 Future 的 done callback 觸發，排程執行緒不需等待圖表生成。
+    """
+    if not futures:
+        return
+
+    remaining = [len(futures)]
+    lock = Lock()
+
+    def on_done(_future):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+        send_sse_event('charts_ready', {'date': date_str, 'count': len(futures)})
+
+    for future in futures:
+        future.add_done_callback(on_done)
+
+
+def scheduled_update(app):
     """定時更新 TWD-HKD 匯率數據
 
     完整流程：
@@ -202,97 +258,217 @@ def scheduled_update():
     2. 重新載入本地數據到 manager
     3. 預生成圖表
     4. 通知前端更新
+
+    同一時間只執行一次；同一天的數據成功更新後，UPDATE_THROTTLE_SECONDS 內的重複觸發會被略過，
+    避免重複重建圖表與發送重複的 SSE 事件。
+
+    Args:
+        app: Flask 應用實例（於註冊排程時綁定）
+
+    Returns:
+        str: 執行結果
+            - 'updated': 已載入最新工作日的數據並通知前端
+            - 'not_updated': 已執行，但沒有最新工作日的數據（或更新失敗）
+            - 'skipped_running': 另一次更新正在執行中，本次未執行
+            - 'skipped_throttled': 今天的數據剛更新過，本次未執行
     """
+    if not _update_lock.acquire(blocking=False):
+        logger.info("⏭️ 排程更新正在執行中，略過本次觸發")
+        return 'skipped_running'
 
-    if not _app:
-        return
+    try:
+        now = datetime.now()
+        today_str = f"{now.year:04d}-{now.month:02d}-{now.day:02d}"
 
-    with _app.app_context():
-        manager = _app.manager
-        try:
-            logger.info("⏰ 排程任務開始：檢查並更新 TWD-HKD 數據...")
+        if (_last_update['date'] == today_str
+                and time.monotonic() - _last_update['ts'] < UPDATE_THROTTLE_SECONDS):
+            logger.info("⏭️ 今天的數據剛更新過，略過重複觸發")
+            return 'skipped_throttled'
 
-            # Step 1: 從 API 抓取缺少的資料
-            fetch_success = _fetch_missing_data()
+        if not _run_scheduled_update(app, now, today_str):
+            return 'not_updated'
 
-            # Step 2: 重新載入數據（不論抓取是否成功，都要載入最新的本地資料）
-            today = datetime.now()
-            today_str = today.strftime('%Y-%m-%d')
+        _last_update['date'] = today_str
+        _last_update['ts'] = time.monotonic()
+        return 'updated'
+    finally:
+        _update_lock.release()
 
-            old_count = len(manager.data)
-            manager.data = manager.load_data()
-            new_count = len(manager.data)
 
-            # 清理超過 180 天的舊數據
-            manager.update_data(180)
+def _run_scheduled_update(app, now, today_str):
+    """執行一次排程更新（呼叫端須已在 app context 中）
+
+    Returns:
+        bool: 是否已載入最新工作日的數據並通知前端
+    """
+    global _update_failures
+    manager = app.manager
+    try:
+        logger.info("⏰ 排程任務開始：檢查並更新 TWD-HKD 數據...")
 
-            # Step 3: 檢查今天的資料是否存在
-            if today_str in manager.data:
-                rate = manager.data[today_str].get('rate')
-                logger.info(f"✅ 找到今天({today_str})的資料: {rate}")
+        # Step 1: 從 API 抓取缺少的資料
+        fetch_success = _fetch_missing_data()
 
-                # 預生成所有圖表
-                manager.warm_up_chart_cache()
+        # Step 2: 重新載入數據（不論抓取是否成功，都要載入最新的本地資料）
+        updated_time = now.isoformat(timespec='seconds')
 
-                # 發送SSE事件通知前端更新
+        # 數據文件未變更時沿用記憶體中的數據，不重新讀取
+        old_count = len(manager.data)
+        if manager.reload_data_if_changed():
+            new_count = len(manager.data)
+            if new_count != old_count:
+                logger.info("數據量變化：%d → %d", old_count, new_count)
+
+        # 清理超過 180 天的舊數據
+        manager.update_data(180)
+
+        # Step 3: 檢查今天的資料是否存在
+        entry = manager.data.get(today_str)
+        if entry is not None:
+            rate = entry.get('rate')
+            logger.info("✅ 找到今天(%s)的資料: %s", today_str, rate)
+
+            # 先發送SSE事件通知前端更新，不必等待圖表生成
+            send_sse_event('rate_updated', {
+                **_RATE_UPDATED_BASE,
+                'date': today_str,
+                'rate': rate,
+                'updated_time': updated_time
+            })
+
+            # 在背景預生成所有圖表，完成後再通知一次
+            _notify_when_charts_ready(manager.warm_up_chart_cache(), today_str)
+            updated = True
+        else:
+            # 如果今天是週末，找最新的工作日
+            expected_date = now.replace(hour=0, minute=0, second=0, microsecond=0)
+            while expected_date.weekday() >= 5:
+                expected_date -= timedelta(days=1)
+            expected_str = expected_date.strftime('%Y-%m-%d')
+
+            entry = manager.data.get(expected_str)
+            if entry is not None:
+                rate = entry.get('rate')
+                logger.info("✅ 找到最新工作日(%s)的資料: %s", expected_str, rate)
                 send_sse_event('rate_updated', {
-                    'date': today_str,
+                    **_RATE_UPDATED_BASE,
+                    'date': expected_str,
                     'rate': rate,
-                    'updated_time': datetime.now().isoformat(),
-                    'message': f'已載入 {today_str} 的匯率資料'
+                    'updated_time': updated_time
                 })
+                _notify_when_charts_ready(manager.warm_up_chart_cache(), expected_str)
+                updated = True
             else:
-                # 如果今天是週末，找最新的工作日
-                expected_date = today.replace(hour=0, minute=0, second=0, microsecond=0)
-                while expected_date.weekday() >= 5:
-                    expected_date -= timedelta(days=1)
-                expected_str = expected_date.strftime('%Y-%m-%d')
-
-                if expected_str in manager.data:
-                    rate = manager.data[expected_str].get('rate')
-                    logger.info(f"✅ 找到最新工作日({expected_str})的資料: {rate}")
-                    manager.warm_up_chart_cache()
-                    send_sse_event('rate_updated', {
-                        'date': expected_str,
-                        'rate': rate,
-                        'updated_time': datetime.now().isoformat(),
-                        'message': f'已載入 {expected_str} 的匯率資料'
-                    })
-                else:
-                    logger.warning(f"⚠️ 本地數據中沒有最新工作日的資料（{expected_str}）")
-                    if not fetch_success:
-                        logger.info("系統將在 09:30 重試")
-
-            if new_count != old_count:
-                logger.info(f"數據量變化：{old_count} → {new_count}")
+                logger.warning("⚠️ 本地數據中沒有最新工作日的資料（%s）", expected_str)
+                if not fetch_success:
+                    logger.info("系統將在 09:30 重試")
+                updated = False
+
+        logger.info("⏰ 排程任務完成")
+        _update_failures = 0
+        return updated
+
+    except Exception:
+        _update_failures += 1
+        # 連續失敗時只在第 1、2、4、8… 次記錄完整 traceback，其餘只記錄一行警告
+        if _update_failures & (_update_failures - 1) == 0:
+            logger.exception("排程更新失敗（連續第 %d 次）", _update_failures)
+        else:
+            logger.warning("排程更新失敗（連續第 %d 次）", _update_failures)
+        return False
 
-            logger.info("⏰ 排程任務完成")
+def run_maintenance(app):
+    """排程維護任務（每 30 分鐘，對齊 :00 / :30）
 
-        except Exception as e:
-            logger.error(f"排程更新失敗: {str(e)}", exc_info=True)
+    1. 09:00 ~ 10:00 之間，若今天尚未成功更新則執行 scheduled_update（09:30 即為重試）
+    2. 清理過期緩存
+    """
+    now = datetime.now()
+    today_str = f"{now.year:04d}-{now.month:02d}-{now.day:02d}"
+    if now.hour == UPDATE_HOUR and _last_update['date'] != today_str:
+        scheduled_update(app)
 
-def clear_cache_with_context():
-    """帶上下文清理緩存"""
-    if not _app:
+    # 清理失敗不影響更新，也不應讓例外中斷本次維護
+    try:
+        app.manager.clear_expired_cache()
+    except Exception:
+        logger.exception("清理過期緩存時發生錯誤")
+
+def _next_aligned_monotonic(interval):
+    """返回下一個對齊 interval 秒整數倍時刻（從當地午夜起算）對應的 monotonic 時間"""
+    now = datetime.now()
+    elapsed = (now - now.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()
+    return time.monotonic() + interval - (elapsed % interval)
+
+def _add_job(first_run, interval, func, *args):
+    """註冊排程任務：first_run（monotonic 時間）時首次執行，之後每 interval 秒執行一次"""
+    _scheduler.enterabs(first_run, 0, _dispatch_job, (next(_job_seq), first_run, interval, func, args))
+
+def _dispatch_job(job_id, due, interval, func, args):
+    """任務到期：排定下一次執行，並把任務交給 _job_pool"""
+    # 若錯過了多個週期（例如系統休眠）只補跑一次
+    now = time.monotonic()
+    next_run = due + interval
+    while next_run <= now:
+        next_run += interval
+    _scheduler.enterabs(next_run, 0, _dispatch_job, (job_id, next_run, interval, func, args))
+
+    previous = _job_futures.get(job_id)
+    if previous is not None and not previous.done():
+        logger.warning("⏭️ 排程任務 %s 的上一次執行尚未結束，略過本次", func.__name__)
         return
-    with _app.app_context():
-        _app.manager.clear_expired_cache()
+    _job_futures[job_id] = _job_pool.submit(_run_job, func, args)
 
-def run_scheduler():
-    """在背景執行緒中執行定時任務"""
-    while True:
-        schedule.run_pending()
-        time.sleep(60)
+def get_next_run_time():
+    """返回下一個排程任務的執行時間（datetime），沒有任務時返回 None"""
+    queue = _scheduler.queue
+    if not queue:
+        return None
+    return datetime.now() + timedelta(seconds=queue[0].time - time.monotonic())
 
-def init_scheduler(app):
-    """初始化並啟動排程"""
-    global _app
-    _app = app
+def _push_app_context(app):
+    """任務執行緒的初始化函式：每個執行緒只推入一次 app context，之後的任務共用"""
+    app.app_context().push()
+
+def _run_job(func, args):
+    """執行單一排程任務"""
+    try:
+        func(*args)
+    except Exception:
+        # 單一任務失敗不影響其他任務
+        logger.exception("執行排程任務時發生未預期的錯誤")
+
+def run_scheduler():
+    """在背景執行緒中執行定時任務，直到 stop_scheduler() 被呼叫
 
-    schedule.every().day.at("09:00").do(scheduled_update)
-    schedule.every().day.at("09:30").do(scheduled_update)  # 重試排程
-    schedule.every().hour.do(clear_cache_with_context)
+    由 sched.scheduler 派發到期的任務，其餘時間睡到下一個任務到期，不輪詢。
+    在 gevent monkey patch 下此執行緒是 greenlet，不佔用額外的系統執行緒。
+    """
+    while not _stop.is_set():
+        delay = _scheduler.run(blocking=False)
+        _stop.wait(timeout=delay if delay is not None else 60)
 
-    scheduler_thread = Thread(target=run_scheduler, daemon=True)
-    scheduler_thread.start()
-    logger.info("✅ 定時任務已啟動（09:00 + 09:30 重試）")
\ No newline at end of file
+def init_scheduler(app):
+    """初始化並啟動排程（任務註冊時直接綁定 app，不經由模組全域變數）"""
+    _add_job(_next_aligned_monotonic(MAINTENANCE_INTERVAL), MAINTENANCE_INTERVAL, run_maintenance, app)
+
+    global _scheduler_thread, _job_pool
+    _stop.clear()
+    _job_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sched-job',
+                                   initializer=_push_app_context, initargs=(app,))
+    _scheduler_thread = Thread(target=run_scheduler, daemon=True)
+    _scheduler_thread.start()
+    logger.info("✅ 定時任務已啟動（09:00 + 09:30 重試）")
+
+def stop_scheduler(timeout=5):
+    """停止排程執行緒，並等待執行中的任務結束（最多 timeout 秒）
+
+    執行緒保持 daemon：Python 會在 atexit 之前等待所有非 daemon 執行緒，
+    改為非 daemon 會讓排程執行緒永遠等不到停止信號。
+    """
+    _stop.set()
+    if _scheduler_thread is not None and _scheduler_thread.is_alive():
+        _scheduler_thread.join(timeout=timeout)
+    if _job_pool is not None:
+        wait(list(_job_futures.values()), timeout=timeout)
+        _job_pool.shutdown(wait=False)
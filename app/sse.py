@@ -1,15 +1,28 @@
-import json
+import orjson
 import queue
 from threading import Lock
 
 sse_clients = []
 sse_lock = Lock()
 
+HEARTBEAT = b"event: heartbeat\ndata: {}\n\n"
+
+
+def format_sse_event(event_type, data):
+    """將事件編碼成完整的 SSE 訊息框（UTF-8 bytes）
+
+    客戶端隊列中的項目一律是已編碼好的 bytes，sse_stream 直接輸出而不再轉換。
+    """
+    return b"event: " + event_type.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+
 def send_sse_event(event_type, data):
-    """發送SSE事件給所有連接的客戶端"""
-    with sse_lock:
-        message = f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    """發送SSE事件給所有連接的客戶端
 
+    訊息只序列化一次，所有客戶端隊列共用同一個 bytes 物件。
+    """
+    message = format_sse_event(event_type, data)
+    with sse_lock:
         # 清理邏輯已移至 sse_stream 的 finally 區塊中，此處只需遍歷發送
         for client_queue in list(sse_clients): # 遍歷副本以提高並行安全性
             try:
@@ -25,10 +38,17 @@ def sse_stream(client_queue):
         while True:
             try:
                 message = client_queue.get(timeout=30)  # 30秒超時
-                yield message
+                # 把已排隊的事件一併取出，合併成一次輸出（一次寫入送出多個事件）
+                pending = [message]
+                while True:
+                    try:
+                        pending.append(client_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                yield b''.join(pending) if len(pending) > 1 else message
             except queue.Empty:
                 # 發送心跳包保持連接
-                yield "event: heartbeat\ndata: {}\n\n"
+                yield HEARTBEAT
     except GeneratorExit:
         # 當客戶端斷開連接時，Flask/Werkzeug 會引發 GeneratorExit
         print("[SSE] 客戶端已斷開連接 (GeneratorExit)。")
@@ -1,4 +1,8 @@
+import os
 import time
+import shutil
+import orjson
+from datetime import datetime
 from threading import Lock
 
 # LRU Cache 類別
@@ -174,20 +178,98 @@ class RateLimiter:
     def __init__(self, max_requests_per_second):
         self.max_requests_per_second = max_requests_per_second
         self.min_interval = 1.0 / max_requests_per_second
-        self.last_request_time = 0
+        self.next_allowed_time = 0.0
         self.lock = Lock()
 
     def wait_if_needed(self):
-        """如果需要的話，等待以符合速率限制"""
+        """如果需要的話，等待以符合速率限制
+
+        在鎖內只預約下一個可用的時間點，睡眠在鎖外進行，
+        多個執行緒可以同時等待各自的時段，不會彼此串行阻塞。
+        """
         with self.lock:
-            current_time = time.time()
-            time_since_last = current_time - self.last_request_time
+            now = time.monotonic()
+            sleep_time = self.next_allowed_time - now
+            self.next_allowed_time = max(now, self.next_allowed_time) + self.min_interval
+
+        if sleep_time > 0:
+            time.sleep(sleep_time)
+
+
+# JSON 數據文件讀寫
+_json_cache = {}  # path -> ((mtime_ns, size), data)
+_json_cache_lock = Lock()
+
+
+def load_json_cached(path):
+    """讀取 JSON 數據文件，文件未變更（mtime 與大小相同）時直接返回已解析的結果
+
+    返回淺拷貝，呼叫端可自由增刪鍵值而不影響快取。
+    """
+    st = os.stat(path)
+    key = (st.st_mtime_ns, st.st_size)
+
+    with _json_cache_lock:
+        cached = _json_cache.get(path)
+        if cached and cached[0] == key:
+            return dict(cached[1])
+
+    with open(path, 'rb') as f:
+        data = orjson.loads(f.read())
+
+    with _json_cache_lock:
+        _json_cache[path] = (key, data)
+    return dict(data)
+
+
+def save_json_compact(path, data):
+    """以緊湊格式（無縮排）保存 JSON 數據文件
+
+    一次序列化為 UTF-8 bytes 寫入暫存檔後再取代原檔，中途中斷也不會留下寫了一半的文件。
+    """
+    payload = orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+    replace_file(tmp_path, path)
+
+
+def replace_file(tmp_path, path):
+    """以暫存檔取代目標文件
+
+    目標為單檔掛載（如 docker-compose 的 bind mount）時無法 rename，改為覆寫內容後刪除暫存檔。
+    """
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        shutil.copyfile(tmp_path, path)
+        os.remove(tmp_path)
+
+
+# 日期輔助函數
+def collect_missing_workdays(existing, start_date, end_date):
+    """收集 start_date 至 end_date（含）之間、尚未存在於 existing 的工作日
+
+    以序數（toordinal）逐日迭代，在任何網路請求之前一次性跳過週末與已有數據。
 
-            if time_since_last < self.min_interval:
-                sleep_time = self.min_interval - time_since_last
-                time.sleep(sleep_time)
+    Args:
+        existing: 已有數據的日期字串集合（或以日期字串為鍵的 dict）
+        start_date: 起始日期（datetime）
+        end_date: 結束日期（datetime，包含）
 
-            self.last_request_time = time.time()
+    Returns:
+        list: [(datetime, 'YYYY-MM-DD'), ...]
+    """
+    missing = []
+    for ordinal in range(start_date.toordinal(), end_date.toordinal() + 1):
+        # 序數 1 為 0001-01-01（週一），(ordinal - 1) % 7 即 weekday()
+        if (ordinal - 1) % 7 >= 5:
+            continue
+        date_obj = datetime.fromordinal(ordinal)
+        date_str = date_obj.date().isoformat()
+        if date_str not in existing:
+            missing.append((date_obj, date_str))
+    return missing
 
 
 # 驗證輔助函數